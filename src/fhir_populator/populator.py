@@ -1,37 +1,77 @@
 import argparse
-import json
+import codecs
+import functools
+import gzip
+import io
+import itertools
 import logging
+import operator
 import os
 import shutil
 import sys
 import tarfile
 import tempfile
-import xml.etree.ElementTree as ElementTree
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from enum import Enum
-from io import BufferedReader
-from typing import List, Optional, Dict
+from typing import FrozenSet, List, Optional, Dict
 
+import ijson
 import inquirer
 import networkx as nx
+import orjson
 import requests
+from lxml import etree as ElementTree
 from rich.logging import RichHandler
 from slugify import slugify
 import semver
 
+# slugify does regex and Unicode-normalization work on every call, and its inputs repeat heavily
+# (the package version is slugified once per resource, tar member names once per extraction), so
+# memoize it for the whole run
+slugify = functools.lru_cache(maxsize=4096)(slugify)
+
 
 class FhirResource:
+    # one instance exists per file in the package, so keep them slotted: attribute access skips
+    # the per-instance __dict__ and thousands of instances stay compact in memory
+    __slots__ = ("file_path", "_raw", "_doc", "type", "resource_type", "id", "_original_id",
+                 "bundle_type", "resource_order")
+
     def __init__(self,
                  file_path: str,
                  package_version: str,
                  generate_missing_ids: bool,
                  versioned_ids: bool):
         self.file_path = file_path
+        with open(self.file_path, "rb") as resource_file:
+            self._raw = resource_file.read()
+        if self._raw.startswith(codecs.BOM_UTF8):
+            # some authoring tools write FHIR files with a UTF-8 BOM, which would break both the
+            # filetype sniffing and the JSON parsers
+            self._raw = self._raw[len(codecs.BOM_UTF8):]
         self.type = self.get_filetype()
+        # XML is parsed exactly once and the tree kept around. JSON documents are only parsed
+        # in full when the payload is actually needed (see parsed_json); metadata lookups before
+        # that stream the cached bytes, so resources that get filtered out never pay a full parse
+        if self.type == FhirResource.FileType.XML:
+            self._doc = ElementTree.fromstring(self._raw)
+        else:
+            self._doc = None
         self.resource_type = self.get_argument("resourceType", raise_on_missing=True)
+        self._original_id = self.get_argument("id", raise_on_missing=False)
+        # Bundles need their type at upload time to pick the request target. Resolve it here:
+        # for a JSON Bundle with no "id" the lookup above already streamed the entire file, but
+        # a Bundle with an early "id" and a corrupt tail would otherwise only blow up in an
+        # upload worker instead of in the collection-time error handling
+        self.bundle_type = self.get_argument("type", raise_on_missing=False) \
+            if self.resource_type == "Bundle" else None
         new_id = self.get_id(package_version, generate_missing_ids, versioned_ids)
         self.id = new_id
         self.resource_order = self.get_resource_order()
 
+    fhir_xml_namespace = "http://hl7.org/fhir"
+
     resource_order_dict = {
         "CodeSystem": 1,
         "ValueSet": 2,
@@ -50,10 +90,7 @@ class FhirResource:
     }
 
     def get_resource_order(self, default_resource_priority: int = 50) -> int:
-        if self.resource_type in self.resource_order_dict:
-            return self.resource_order_dict[self.resource_type]
-        else:
-            return default_resource_priority
+        return self.resource_order_dict.get(self.resource_type, default_resource_priority)
 
     def get_argument(self, argument: str, raise_on_missing: bool = False) -> str:
         if self.type == FhirResource.FileType.XML:
@@ -61,10 +98,20 @@ class FhirResource:
         else:
             return self.get_argument_json(argument, raise_on_missing)
 
-    def get_payload(self, rewrite_version: Optional[str] = None) -> str:
-        # if rewrite_version is None:
-        #     with open(self.file_path, "r", encoding="utf8") as fs:
-        #         return fs.read()
+    def needs_rewrite(self, rewrite_version: Optional[str]) -> bool:
+        """
+        check whether the upload payload has to be rebuilt from the parsed document, or whether
+        the bytes on disk can be sent as-is
+        :param rewrite_version: the version to rewrite the resource version to, if any
+        :return: True if the payload requires the parse/serialize round-trip
+        """
+        return rewrite_version is not None or self.id != self._original_id
+
+    def get_payload(self, rewrite_version: Optional[str] = None) -> bytes:
+        if not self.needs_rewrite(rewrite_version):
+            # nothing needs rewriting, so the bytes on disk already are the exact payload -
+            # skip the parse/serialize round-trip entirely
+            return self._raw
         if self.type == FhirResource.FileType.XML:
             return self.get_payload_rewrite_xml(rewrite_version)
         else:
@@ -76,44 +123,76 @@ class FhirResource:
 
     def get_filetype(self) -> FileType:
         """
-        check if this file is XML or JSON
+        check if this file is XML or JSON, by peeking at the first non-whitespace byte of the
+        already-loaded content - no extra file I/O is needed
         https://codereview.stackexchange.com/a/137926
         :return: FhirResource.FileType enum member
         """
-        with open(self.file_path, encoding="utf8") as unknown_file:
-            c = unknown_file.read(1)
-            if c != '<':
-                return FhirResource.FileType.JSON
+        if self._raw[:1024].lstrip()[:1] == b"<":
             return FhirResource.FileType.XML
+        return FhirResource.FileType.JSON
 
     def __repr__(self):
         return f"FHIR Resource ({self.resource_type}) @ {self.file_path} - {self.resource_type}"
 
-    def get_payload_rewrite_xml(self, rewrite_version: Optional[str]) -> str:
-        tree = ElementTree.parse(self.file_path)
-        root = tree.getroot()
+    def find_xml_node(self, root, tag: str):
+        """
+        find a direct child element, trying the FHIR XML namespace first. FHIR resources declare
+        xmlns="http://hl7.org/fhir", so a plain find() on the local tag name would silently
+        return None.
+        :param root: the element to search below
+        :param tag: the local tag name of the child element
+        :return: the child element, or None
+        """
+        node = root.find(f"{{{self.fhir_xml_namespace}}}{tag}")
+        if node is None:
+            node = root.find(tag)
+        return node
+
+    def get_payload_rewrite_xml(self, rewrite_version: Optional[str]) -> bytes:
+        root = self._doc
         if rewrite_version is not None:
-            version_node = root.find("version")
+            version_node = self.find_xml_node(root, "version")
             if version_node is not None:
-                version_node.text = rewrite_version
+                version_node.set("value", rewrite_version)
         if self.id is not None:
-            id_node = root.find("id")
-            id_node.text = self.id
-        return ElementTree.tostring(root, encoding="unicode")
+            id_node = self.find_xml_node(root, "id")
+            if id_node is None:
+                # the id element is required to be the first child of the resource
+                id_node = ElementTree.Element(f"{{{self.fhir_xml_namespace}}}id")
+                root.insert(0, id_node)
+            id_node.set("value", self.id)
+        return ElementTree.tostring(root, encoding="utf-8", xml_declaration=True)
 
-    def get_payload_rewrite_json(self, rewrite_version: Optional[str], indent: int = 2) -> str:
-        with open(self.file_path, "r", encoding="utf8") as jf:
-            json_dict = json.load(jf)
+    def parsed_json(self) -> dict:
+        """
+        return the fully parsed JSON document, parsing the cached bytes on first use
+        :return: the resource dict
+        """
+        if self._doc is None:
+            self._doc = orjson.loads(self._raw)
+        return self._doc
+
+    def rewrite_json(self, rewrite_version: Optional[str]) -> dict:
+        """
+        apply the version and id rewrites to the cached JSON document and return it
+        :param rewrite_version: the version to rewrite the resource version to, if any
+        :return: the (rewritten) resource dict
+        """
+        json_dict = self.parsed_json()
         if rewrite_version is not None:
             if "version" in json_dict:
                 json_dict["version"] = rewrite_version
         if self.id is not None:
             json_dict["id"] = self.id
-        return json.dumps(json_dict, indent=indent)
+        return json_dict
+
+    def get_payload_rewrite_json(self, rewrite_version: Optional[str]) -> bytes:
+        # no pretty-printing for wire payloads: indentation only costs serialization time and bytes
+        return orjson.dumps(self.rewrite_json(rewrite_version))
 
     def get_argument_xml(self, argument: str, raise_on_missing: bool = False):
-        tree = ElementTree.parse(self.file_path)
-        root = tree.getroot()
+        root = self._doc
         if argument == "resourceType":
             # resource type is provided as the name of the tag, instead of as an attribute
             tag = root.tag
@@ -121,26 +200,35 @@ class FhirResource:
                 return tag.split("}")[1]  # Tag name without namespace
             else:
                 return tag  # Tag does not seem to contain a namespace
-        res_node = root.find(argument)
+        res_node = self.find_xml_node(root, argument)
         if res_node is None and raise_on_missing:
             raise LookupError(f"the resource {self.file_path} does not have an attribute {argument}!")
         elif res_node is None:
             return None
         else:
-            return res_node.text
+            # FHIR XML carries primitive values in the "value" attribute, not in the element text
+            return res_node.get("value", res_node.text)
 
     def get_argument_json(self, argument: str, raise_on_missing: bool = False) -> Optional[str]:
-        with open(self.file_path, encoding="utf8") as jf:
-            json_dict = json.load(jf)
+        if self._doc is not None:
+            json_dict = self._doc
             if argument not in json_dict and raise_on_missing:
                 raise LookupError(f"the resource {self.file_path} does not have an attribute {argument}!")
             elif argument not in json_dict:
                 return None
             else:
                 return json_dict[argument]
+        # the document has not been parsed in full yet; stream the cached bytes only until the
+        # requested top-level key appears - resourceType and id sit at the front of FHIR files
+        for prefix, _, value in ijson.parse(io.BytesIO(self._raw)):
+            if prefix == argument:
+                return value
+        if raise_on_missing:
+            raise LookupError(f"the resource {self.file_path} does not have an attribute {argument}!")
+        return None
 
     def get_id(self, package_version, generate_missing_ids, versioned_ids) -> Optional[str]:
-        resource_id = self.get_argument("id", raise_on_missing=False)
+        resource_id = self._original_id
         if resource_id is None and not generate_missing_ids:
             return None
         filename_no_ext = os.path.splitext(os.path.basename(self.file_path))[0]
@@ -164,7 +252,7 @@ class PopulatorSettings:
     packages: List[str]
     include_examples: bool
     rewrite_versions: bool
-    exclude_resource_type: List[str]
+    exclude_resource_type: FrozenSet[str]
     log_level: str
     only_put: bool
     versioned_ids: bool
@@ -174,7 +262,9 @@ class PopulatorSettings:
     has_proxy: bool
     proxy_verify: Optional[str]
     proxy_for_fhir: bool
-    only: List[str]
+    only: FrozenSet[str]
+    upload_workers: int
+    batch_size: int
     log: logging.Logger
     persistence_dir: Optional[str]
     persist: bool
@@ -196,14 +286,18 @@ class PopulatorSettings:
         self.proxy_verify = args.proxy_verify
         self.proxy_for_fhir = args.proxy_for_fhir
         self.has_proxy = self.http_proxy is not None or self.https_proxy is not None
-        self.exclude_resource_type = [a.lower() for a in args.exclude_resource_type] \
+        # frozensets, so that the per-resource filter in collect_package_resources is a hash
+        # lookup instead of a list scan
+        self.exclude_resource_type = frozenset(a.lower() for a in args.exclude_resource_type) \
             if args.exclude_resource_type is not None \
-            else []
-        self.only = [a.lower() for a in args.only] \
+            else frozenset()
+        self.only = frozenset(a.lower() for a in args.only) \
             if args.only is not None \
-            else []
+            else frozenset()
         self.only_put = args.only_put
         self.versioned_ids = args.versioned_ids
+        self.upload_workers = args.upload_workers
+        self.batch_size = args.batch_size
         self.persistence_dir = args.persistence_dir
         self.persist = args.persist
         self.from_persistence = args.from_persistence
@@ -224,17 +318,22 @@ class Populator:
         "hl7.fhir.r4",
     ]
 
+    # request bodies above this size are gzipped before uploading; FHIR JSON/XML compresses
+    # extremely well, and at this compression level the compressor outruns the TCP send anyway
+    gzip_threshold_bytes = 4096
+    gzip_compress_level = 1
+
     def __init__(self):
         args = self.parse_args()
         self.log = self.configure_logger(args)
         self.args = PopulatorSettings(args, self.log)
         self.temp_dir = tempfile.mkdtemp(prefix="fhir-populator")
-        self.download_dir = os.path.join(self.temp_dir, "download")
-        os.mkdir(self.download_dir)
         self.extract_dir = os.path.join(self.temp_dir, "extract")
         os.mkdir(self.extract_dir)
         self.fhir_requests_session = self.configure_session(configure_auth=True,
                                                             configure_proxy=self.args.proxy_for_fhir)
+        self.latest_version_cache: Dict[str, str] = {}
+        self.package_json_cache: Dict[str, dict] = {}
 
     def __del__(self):
         if self.log is not None:
@@ -245,9 +344,29 @@ class Populator:
 
     def configure_session(self, configure_auth: bool, configure_proxy: bool) -> requests.Session:
         session = requests.Session()
+        # make sure the keep-alive pool has one connection per upload worker, so that parallel
+        # uploads do not serialize on the default pool size; transient gateway errors are retried
+        # with a short backoff before they reach the interactive error handling
+        pool_size = max(self.args.upload_workers, 10)
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size,
+            pool_maxsize=pool_size,
+            max_retries=requests.adapters.Retry(
+                total=3,
+                backoff_factor=0.2,
+                status_forcelist=[502, 503, 504],
+                # PUT is idempotent and safe to repeat (the default allowed_methods covers it);
+                # POST is not retried, since a gateway timeout does not prove the create was
+                # never processed. A server that keeps failing hands its last response back to
+                # the normal error handling instead of raising RetryError out of a worker
+                raise_on_status=False
+            )
+        )
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
         if configure_auth:
             if self.args.authorization_header is not None:
-                self.fhir_requests_session.headers.update({
+                session.headers.update({
                     "Authorization": self.args.authorization_header
                 })
                 self.log.debug(f"Using Authorization header: {self.args.authorization_header[:5]}...")
@@ -331,6 +450,19 @@ class Populator:
             help="Only upload the resource types provided here, " +
                  "e.g. only StructureDefinitions, CodeSystems and ValueSets"
         )
+        parser.add_argument(
+            "--upload-workers", type=int, default=4,
+            help="The number of parallel upload threads. Resources are still uploaded tier-by-tier " +
+                 "(e.g. CodeSystems before ValueSets), but files within one tier are uploaded concurrently. " +
+                 "Use 1 to upload strictly sequentially."
+        )
+        parser.add_argument(
+            "--batch-size", type=int, default=1,
+            help="If greater than 1, JSON resources within one tier are grouped into FHIR transaction " +
+                 "Bundles of at most this many entries, so that many small resources share a single " +
+                 "HTTP round-trip. Requires a server that supports transaction Bundles. " +
+                 "With 1, every resource is uploaded individually."
+        )
         parser.add_argument(
             "--registry-url", type=str, default="https://packages.simplifier.net",
             help="The FHIR registry url, Simplifier by default"
@@ -350,30 +482,43 @@ class Populator:
         return parser.parse_args()
 
     def download_packages(self, packages: List[str]) -> nx.DiGraph:
-        untar_folders = []
         download_session = self.configure_session(configure_auth=False, configure_proxy=True)
 
         get_deps = self.args.get_dependencies
         dependency_graph = nx.DiGraph()
         packages_to_download = list(packages)
-        downloaded_packages = list()
-        while len(packages_to_download) > 0:
-            package = packages_to_download.pop(0)
-            if package in downloaded_packages:
-                self.log.debug(f"Package {package} is already downloaded.")
-                continue
-            self.log.info(f"Downloading package with spec {package}")
-            package_path = self.download_untar_package(package_name=package, session=download_session)
-            untar_folders.append(package_path)
-            dependency_graph.add_node(package, path=package_path)
-            if get_deps:
-                dependencies = self.gather_dependencies(package_path)
-                for dep in dependencies:
-                    ignored = [ign for ign in self.ignored_dependencies if dep.startswith(ign)]
-                    if not any(ignored):
-                        dependency_graph.add_edge(dep, package)
-                        packages_to_download.append(dep)
-                downloaded_packages.append(package)
+        downloaded_packages = set()
+        # expand the dependency BFS level by level: every package in the current frontier is
+        # independent of the others, so the downloads are issued concurrently, and the
+        # dependencies discovered in their package.json files form the next frontier
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            while len(packages_to_download) > 0:
+                frontier = []
+                frontier_set = set()
+                for package in packages_to_download:
+                    if package in downloaded_packages or package in frontier_set:
+                        self.log.debug(f"Package {package} is already downloaded.")
+                        continue
+                    self.log.info(f"Downloading package with spec {package}")
+                    frontier.append(package)
+                    frontier_set.add(package)
+                packages_to_download = []
+                future_to_package = {
+                    executor.submit(self.download_untar_package, package, download_session): package
+                    for package in frontier
+                }
+                for future in as_completed(future_to_package):
+                    package = future_to_package[future]
+                    package_path = future.result()
+                    downloaded_packages.add(package)
+                    dependency_graph.add_node(package, path=package_path)
+                    if get_deps:
+                        dependencies = self.gather_dependencies(package_path)
+                        for dep in dependencies:
+                            ignored = [ign for ign in self.ignored_dependencies if dep.startswith(ign)]
+                            if not any(ignored):
+                                dependency_graph.add_edge(dep, package)
+                                packages_to_download.append(dep)
         self.log.debug("Packages downloaded with dependencies:")
         for node in dependency_graph.nodes:
             self.log.debug(f" - {node}")
@@ -393,54 +538,48 @@ class Populator:
 
         request_url = f"{self.args.registry_url}/{package_id}/{package_version}"
         download_filename = f"{package_id}_{package_version}"
-        download_path = os.path.join(self.download_dir, f"{download_filename}.tar")
         extract_path = os.path.join(self.extract_dir, download_filename)
-        download_request = requests.Request(
-            method="GET",
-            url=request_url
-        ).prepare()
-        download_response = session.send(download_request, stream=True)
-        with open(download_path, "wb") as download_fs:
-            for chunk in download_response.iter_content(chunk_size=8192):
-                download_fs.write(chunk)
-        self.log.debug(f"Downloaded to {download_path}")
+        download_response = session.get(request_url, stream=True)
         try:
-            with tarfile.open(download_path) as download_tar_fs:
+            # pipe the response body straight into the tar extractor: "r|*" reads the archive as a
+            # non-seekable stream (detecting gzip transparently), so members are extracted while
+            # the download is still in flight and the tarball never touches the disk
+            with tarfile.open(fileobj=download_response.raw, mode="r|*",
+                              bufsize=1024 * 1024) as download_tar_fs:
                 for tarinfo in download_tar_fs:
                     try:
+                        if not tarinfo.isfile():
+                            continue
                         extract_dir = os.path.dirname(tarinfo.path)
                         t_filename, t_ext = os.path.splitext(os.path.basename(tarinfo.path))
                         slug_filename = slugify(t_filename)
-                        extract_filename = f"{slug_filename}{t_ext}"
-                        extract_to_folder = os.path.join(extract_path, extract_dir)
-                        os.makedirs(extract_to_folder, exist_ok=True)
-                        extract_to = os.path.join(extract_to_folder, extract_filename)
-                        with open(extract_to, "wb") as out_fp:
-                            tar_br: BufferedReader
-                            with download_tar_fs.extractfile(tarinfo) as tar_br:
-                                out_fp.write(tar_br.read())
-                        self.log.debug(f"Extracted {extract_to}")
+                        # rename the member in-place, then let tarfile do the actual extraction:
+                        # it streams the member to disk in chunks instead of materializing it
+                        tarinfo.name = os.path.join(extract_dir, f"{slug_filename}{t_ext}")
+                        download_tar_fs.extract(tarinfo, path=extract_path)
+                        self.log.debug(f"Extracted {os.path.join(extract_path, tarinfo.name)}")
                     except (tarfile.TarError, IOError, OSError):
-                        logging.exception(f"Unhandled error extracting member '{tarinfo}' from {download_path}." +
+                        logging.exception(f"Unhandled error extracting member '{tarinfo}' from {request_url}." +
                                           "Extraction will continue.")
                         continue
         except (tarfile.TarError, IOError, OSError):
-            logging.exception(f"Unhandled error extracting archive {download_path}")
+            logging.exception(f"Unhandled error extracting archive from {request_url}")
             exit(1)
+        finally:
+            download_response.close()
         self.log.debug(f"Extracted to {extract_path}")
         return extract_path
 
     def get_latest_package_version(self, package_name: str) -> str:
+        if package_name in self.latest_version_cache:
+            return self.latest_version_cache[package_name]
         lookup_url = f"{self.args.registry_url}/{package_name}"
-        lookup_request = requests.Request(
-            method="GET",
-            url=lookup_url
-        ).prepare()
-        response = self.fhir_requests_session.send(lookup_request)
+        response = self.fhir_requests_session.get(lookup_url)
         versions = [v["version"] for v in response.json()["versions"].values()]
         self.log.debug(f"Available versions for '{package_name}': {versions}")
         last_version = versions[-1]
         self.log.debug(f"Latest version: {last_version}")
+        self.latest_version_cache[package_name] = last_version
         return last_version
 
     def remove_extract_dir_from_dependency_graph_paths(self, dependency_graph):
@@ -457,12 +596,12 @@ class Populator:
     @staticmethod
     def save_dependency_graph(dependency_graph: nx.DiGraph, persistence_graph_path: str):
         dependency_graph_json = nx.node_link_data(dependency_graph)
-        with open(persistence_graph_path, "w", encoding="utf-8") as persistence_graph_file:
-            json.dump(dependency_graph_json, persistence_graph_file)
+        with open(persistence_graph_path, "wb") as persistence_graph_file:
+            persistence_graph_file.write(orjson.dumps(dependency_graph_json))
 
     def update_dependency_graph(self, persistence_graph_path, dependency_graph) -> nx.DiGraph:
-        with open(persistence_graph_path, "r", encoding="utf-8") as persistence_graph_file:
-            persistence_graph_json = json.load(persistence_graph_file)
+        with open(persistence_graph_path, "rb") as persistence_graph_file:
+            persistence_graph_json = orjson.loads(persistence_graph_file.read())
             persistence_graph = nx.node_link_graph(persistence_graph_json)
             dependency_graph = nx.compose(dependency_graph, persistence_graph)
             self.save_dependency_graph(dependency_graph, persistence_graph_path)
@@ -496,8 +635,8 @@ class Populator:
 
     @staticmethod
     def load_dependency_graph(dependency_graph_path: str) -> nx.DiGraph:
-        with open(dependency_graph_path, "r", encoding="utf-8") as dependency_graph_file:
-            dependency_graph_json = json.load(dependency_graph_file)
+        with open(dependency_graph_path, "rb") as dependency_graph_file:
+            dependency_graph_json = orjson.loads(dependency_graph_file.read())
             dependency_graph = nx.node_link_graph(dependency_graph_json)
             return dependency_graph
 
@@ -569,51 +708,33 @@ class Populator:
         nodes of the provided packages, and still work
         :return: None
         """
-        ordered_dependencies = nx.topological_sort(dependency_graph)
+        ordered_dependencies = list(nx.topological_sort(dependency_graph))
         # order the resources in topological order: every node before its dependencies
-        for package_node in ordered_dependencies:
+        prefetch_executor = ThreadPoolExecutor(max_workers=1)
+        prefetched_files = None
+        for package_index, package_node in enumerate(ordered_dependencies):
             node_with_info = dependency_graph.nodes[package_node]
             # topological sort only returns the node name as str
             package_dir = node_with_info["path"]
             self.log.debug("Uploading package '%s' files from package directory: %s", package_node, package_dir)
-            self.log.debug("Uploading package '%s' files from package directory: %s", package_node, package_dir)
-            fhir_files = []
             package_json = self.read_package_json(package_dir)
-            package_version = package_json["version"]
             if package_json is None:
                 raise FileNotFoundError(f"package.json was not found within {package_dir}!")
-            for (directory_path, _, filenames) in os.walk(package_dir):
-                file_name: str
-                for file_name in filenames:
-                    if os.path.basename(directory_path) == "other":  # other directory SHALL be ignored
-                        # https://wiki.hl7.org/FHIR_NPM_Package_Spec#Format
-                        continue
-                    if file_name == "package.json" or file_name == "index.json":
-                        continue
-                    elif file_name.endswith(".sch"):  # FHIR Shorthand
-                        continue
-                    full_path = os.path.join(directory_path, file_name)
-                    encoded_path = full_path.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
-                    if os.path.basename(os.path.dirname(encoded_path)) == "examples" and not self.args.include_examples:
-                        self.log.debug(f"file at {encoded_path} is an example and ignored.")
-                        continue
-                    # noinspection PyBroadException
-                    try:
-                        fhir_resource = FhirResource(encoded_path, package_version, self.args.only_put,
-                                                     self.args.versioned_ids)
-                        r_type = fhir_resource.resource_type.lower()
-                        if (r_type in self.args.exclude_resource_type) or (
-                                len(self.args.only) != 0 and r_type not in self.args.only):
-                            self.log.debug(
-                                f"Resource {encoded_path} is of resource type {r_type}" +
-                                f" and is skipped.")
-                            continue
-                        else:
-                            fhir_files.append(fhir_resource)
-                    except (LookupError, json.decoder.JSONDecodeError):
-                        self.log.error(f"Error reading FHIR resource as JSON: {file_name}")
-                    except Exception:
-                        self.log.exception(f"Unhandled error reading FHIR resource from package: {file_name}")
+            package_version = package_json["version"]
+            if prefetched_files is not None:
+                fhir_files = prefetched_files.result()
+            else:
+                fhir_files = self.collect_package_resources(package_dir, package_version)
+            # collect (walk, parse, filter) the next package on a background thread, so that the
+            # CPU-bound resource prep overlaps with the network-bound upload of this package
+            prefetched_files = None
+            if package_index + 1 < len(ordered_dependencies):
+                next_node = ordered_dependencies[package_index + 1]
+                next_dir = dependency_graph.nodes[next_node]["path"]
+                next_json = self.read_package_json(next_dir)
+                if next_json is not None:
+                    prefetched_files = prefetch_executor.submit(
+                        self.collect_package_resources, next_dir, next_json["version"])
             fhir_files = self.sort_fhir_files(fhir_files)
             rewrite_version = None
             package_version = package_json["version"]
@@ -629,60 +750,270 @@ class Populator:
                 rewrite_version = package_version
                 self.log.warning(f"rewriting resources in package {package_node}")
             num_files = len(fhir_files)
-            while len(fhir_files) > 0:
-                fhir_file = fhir_files.pop(0)
-                encoded_path = fhir_file.file_path.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
-                self.log.info(
-                    f"Uploading {encoded_path} ({fhir_file.resource_type}) ({num_files - len(fhir_files)}/{num_files})")
-                upload_url = f"{self.args.endpoint}/{fhir_file.resource_type}"
-                request_method = "POST"
-                if fhir_file.id is not None:
-                    request_method = "PUT"
-                    upload_url += f"/{fhir_file.id}"
-                if fhir_file.resource_type == "Bundle":
-                    bundle_type = fhir_file.get_argument("type", raise_on_missing=False)
-                    if bundle_type == "transaction":
-                        upload_url = self.args.endpoint
-                        request_method = "POST"
-                content_type = "application/xml" if fhir_file.type == FhirResource.FileType.XML else "application/json"
-                payload = fhir_file.get_payload(rewrite_version=rewrite_version).encode("utf-8")
-                upload_request = requests.Request(
-                    method=request_method,
-                    url=upload_url,
-                    headers={
-                        "Content-Type": content_type,
-                        "Accept": "application/json"
-                    },
-                    data=payload
-                ).prepare()
-                self.log.info(f"uploading to {upload_url} (content type: {content_type})")
-                upload_result = self.fhir_requests_session.send(upload_request)
+            uploaded_count = 0
+            # resources within one tier (same resource_order) have no ordering constraints among
+            # each other, so they can be uploaded in parallel; tiers are processed strictly in order
+            for _, tier in itertools.groupby(fhir_files, key=operator.attrgetter("resource_order")):
+                tier_files = list(tier)
+                failed_files = []
+                batch_fallback_files = []
+                standalone_files, batches = self.plan_tier_uploads(tier_files)
+                with ThreadPoolExecutor(max_workers=self.args.upload_workers) as executor:
+                    future_to_files = {
+                        executor.submit(self.upload_resource, fhir_file, rewrite_version): [fhir_file]
+                        for fhir_file in standalone_files
+                    }
+                    future_to_files.update({
+                        executor.submit(self.upload_batch, batch, rewrite_version): batch
+                        for batch in batches
+                    })
+                    for future in as_completed(future_to_files):
+                        batch_files = future_to_files[future]
+                        upload_result = future.result()
+                        for fhir_file in batch_files:
+                            uploaded_count += 1
+                            # file_path already went through the surrogateescape round-trip when
+                            # the resource was collected
+                            self.log.info(
+                                f"Uploaded {fhir_file.file_path} ({fhir_file.resource_type}) " +
+                                f"({uploaded_count}/{num_files})")
+                        if 200 <= upload_result.status_code < 300:
+                            self.log.debug(f"uploaded {len(batch_files)} resource(s) " +
+                                           f"with status {upload_result.status_code}")
+                        else:
+                            if len(batch_files) == 1:
+                                self.log_upload_failure(
+                                    f"{batch_files[0].file_path} ({batch_files[0].resource_type})", upload_result)
+                                failed_files.append(batch_files[0])
+                            else:
+                                self.log_upload_failure(
+                                    f"transaction Bundle of {len(batch_files)} resources", upload_result)
+                                # a single bad resource makes the server reject the whole
+                                # transaction, so the other members of the batch never got a
+                                # real chance; degrade them to individual uploads here
+                                batch_fallback_files.extend(batch_files)
+                    if batch_fallback_files:
+                        self.log.warning(
+                            f"retrying {len(batch_fallback_files)} resource(s) from rejected " +
+                            f"batches individually")
+                        fallback_futures = {
+                            executor.submit(self.upload_resource, fhir_file, rewrite_version): fhir_file
+                            for fhir_file in batch_fallback_files
+                        }
+                        for future in as_completed(fallback_futures):
+                            fhir_file = fallback_futures[future]
+                            upload_result = future.result()
+                            if 200 <= upload_result.status_code < 300:
+                                self.log.debug(f"uploaded {fhir_file.resource_type} " +
+                                               f"with status {upload_result.status_code}")
+                            else:
+                                self.log_upload_failure(
+                                    f"{fhir_file.file_path} ({fhir_file.resource_type})", upload_result)
+                                failed_files.append(fhir_file)
+                self.retry_failed_uploads(failed_files, package_node, rewrite_version)
+        prefetch_executor.shutdown()
+
+    def collect_package_resources(self, package_dir: str, package_version: str) -> List[FhirResource]:
+        """
+        walk one extracted package directory and construct FhirResource objects for every file
+        that should be uploaded, applying the example/other-folder rules of the FHIR NPM Package
+        Spec and the --exclude-resource-type/--only filters.
+        :param package_dir: the extracted package directory
+        :param package_version: the version from the package's package.json
+        :return: the list of resources to upload
+        """
+        fhir_files = []
+        for entry in self.iter_files(package_dir):
+            file_name = entry.name
+            directory_path = os.path.dirname(entry.path)
+            if os.path.basename(directory_path) == "other":  # other directory SHALL be ignored
+                # https://wiki.hl7.org/FHIR_NPM_Package_Spec#Format
+                continue
+            if file_name == "package.json" or file_name == "index.json":
+                continue
+            elif file_name.endswith(".sch"):  # FHIR Shorthand
+                continue
+            # the surrogateescape round-trip only matters for non-ASCII filenames (mis-decoded
+            # names, especially on BSD/macOS); the common all-ASCII path skips it entirely
+            if entry.path.isascii():
+                encoded_path = entry.path
+            else:
+                encoded_path = entry.path.encode('utf-8', 'surrogateescape').decode('utf-8', 'replace')
+            if os.path.basename(os.path.dirname(encoded_path)) == "examples" and not self.args.include_examples:
+                self.log.debug(f"file at {encoded_path} is an example and ignored.")
+                continue
+            # noinspection PyBroadException
+            try:
+                fhir_resource = FhirResource(encoded_path, package_version, self.args.only_put,
+                                             self.args.versioned_ids)
+                r_type = fhir_resource.resource_type.lower()
+                if (r_type in self.args.exclude_resource_type) or (
+                        self.args.only and r_type not in self.args.only):
+                    self.log.debug(
+                        f"Resource {encoded_path} is of resource type {r_type}" +
+                        f" and is skipped.")
+                    continue
+                else:
+                    rewrite_version = package_version if self.args.rewrite_versions else None
+                    will_be_batched = (self.args.batch_size > 1
+                                       and fhir_resource.type == FhirResource.FileType.JSON
+                                       and fhir_resource.resource_type != "Bundle")
+                    if fhir_resource.type == FhirResource.FileType.JSON and (
+                            will_be_batched or fhir_resource.needs_rewrite(rewrite_version)):
+                        # the upload will need the fully parsed document (batching embeds it in
+                        # a transaction Bundle, rewrites rebuild the payload from it), but the
+                        # streaming metadata lookups above only read the front of the file.
+                        # Parse it in full now, so a corrupt document is caught and skipped
+                        # here instead of raising out of an upload worker thread
+                        fhir_resource.parsed_json()
+                    fhir_files.append(fhir_resource)
+            except (LookupError, orjson.JSONDecodeError, ijson.JSONError):
+                self.log.error(f"Error reading FHIR resource as JSON: {file_name}")
+            except Exception:
+                self.log.exception(f"Unhandled error reading FHIR resource from package: {file_name}")
+        return fhir_files
+
+    def plan_tier_uploads(self, tier_files: List[FhirResource]):
+        """
+        split the resources of one tier into individually uploaded files and transaction Bundle
+        batches of at most args.batch_size entries. XML resources and resources that are themselves
+        Bundles cannot be nested into a JSON transaction Bundle and always go out individually.
+        :param tier_files: the resources of one resource_order tier
+        :return: a tuple of (standalone resources, list of batches)
+        """
+        batch_size = self.args.batch_size
+        standalone_files = []
+        batchable_files = []
+        for fhir_file in tier_files:
+            if batch_size <= 1 \
+                    or fhir_file.type == FhirResource.FileType.XML \
+                    or fhir_file.resource_type == "Bundle":
+                standalone_files.append(fhir_file)
+            else:
+                batchable_files.append(fhir_file)
+        batches = []
+        for batch_start in range(0, len(batchable_files), batch_size):
+            batch = batchable_files[batch_start:batch_start + batch_size]
+            if len(batch) == 1:
+                standalone_files.append(batch[0])
+            else:
+                batches.append(batch)
+        return standalone_files, batches
+
+    def upload_batch(self, batch: List[FhirResource], rewrite_version: Optional[str]) -> requests.Response:
+        """
+        upload a batch of JSON resources as one FHIR transaction Bundle, so that the whole batch
+        shares a single HTTP round-trip.
+        :param batch: the resources to upload
+        :param rewrite_version: the version to rewrite the resource versions to, if any
+        :return: the server's response
+        """
+        entries = []
+        for fhir_file in batch:
+            if fhir_file.id is not None:
+                entry_request = {"method": "PUT", "url": f"{fhir_file.resource_type}/{fhir_file.id}"}
+            else:
+                entry_request = {"method": "POST", "url": fhir_file.resource_type}
+            entries.append({
+                "resource": fhir_file.rewrite_json(rewrite_version),
+                "request": entry_request
+            })
+        bundle = {
+            "resourceType": "Bundle",
+            "type": "transaction",
+            "entry": entries
+        }
+        headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }
+        payload = self.compress_payload(orjson.dumps(bundle), headers)
+        self.log.info(f"uploading transaction Bundle of {len(batch)} resources to {self.args.endpoint}")
+        return self.fhir_requests_session.post(self.args.endpoint, headers=headers, data=payload)
+
+    def upload_resource(self, fhir_file: FhirResource, rewrite_version: Optional[str]) -> requests.Response:
+        """
+        upload a single FHIR resource to the server.
+        When an ID is present in the resource, this will use PUT, otherwise POST; transaction Bundles
+        are POSTed against the endpoint root as mandated by the FHIR REST spec.
+        :param fhir_file: the resource to upload
+        :param rewrite_version: the version to rewrite the resource version to, if any
+        :return: the server's response
+        """
+        upload_url = f"{self.args.endpoint}/{fhir_file.resource_type}"
+        request_method = "POST"
+        if fhir_file.id is not None:
+            request_method = "PUT"
+            upload_url += f"/{fhir_file.id}"
+        if fhir_file.bundle_type == "transaction":
+            upload_url = self.args.endpoint
+            request_method = "POST"
+        content_type = "application/xml" if fhir_file.type == FhirResource.FileType.XML else "application/json"
+        headers = {
+            "Content-Type": content_type,
+            "Accept": "application/json"
+        }
+        payload = self.compress_payload(fhir_file.get_payload(rewrite_version=rewrite_version), headers)
+        self.log.info(f"uploading to {upload_url} (content type: {content_type})")
+        return self.fhir_requests_session.request(request_method, upload_url, headers=headers, data=payload)
+
+    def compress_payload(self, payload: bytes, headers: Dict[str, str]) -> bytes:
+        """
+        gzip an upload body when it is large enough to be worth the CPU, announcing the
+        compression to the server via the Content-Encoding header.
+        :param payload: the serialized request body
+        :param headers: the request headers, updated in place when compressing
+        :return: the (possibly compressed) body
+        """
+        if len(payload) > self.gzip_threshold_bytes:
+            headers["Content-Encoding"] = "gzip"
+            return gzip.compress(payload, compresslevel=self.gzip_compress_level)
+        return payload
+
+    def log_upload_failure(self, description: str, upload_result: requests.Response):
+        self.log.error(f"Error status code {upload_result.status_code} for {description}")
+        operation_outcome = upload_result.json()
+        self.log.error(operation_outcome["issue"])
+
+    def retry_failed_uploads(self, failed_files: List[FhirResource], package_node: str,
+                             rewrite_version: Optional[str]):
+        """
+        handle the resources that could not be uploaded in the parallel pass. The user is prompted
+        for each failed file (unless --non-interactive is given), so that prompts never race the
+        upload worker threads.
+        :param failed_files: the resources that the server rejected
+        :param package_node: the name of the package currently being uploaded
+        :param rewrite_version: the version to rewrite resource versions to, if any
+        :return: None
+        """
+        failed_files = deque(failed_files)
+        while len(failed_files) > 0:
+            fhir_file = failed_files.popleft()
+            if self.args.non_interactive:
+                action = "Ignore"
+            else:
+                choices = [
+                    inquirer.List('action',
+                                  f"What should we do with {fhir_file.file_path} " +
+                                  f"(current package: {package_node})?",
+                                  choices=[("Ignore (continue with the next resource)", "Ignore"),
+                                           ("Retry (because you have changed/uploaded something else)", "Retry")
+                                           ])
+                ]
+                sys.stdout.flush()
+                action = inquirer.prompt(choices)['action']
+                sys.stdout.flush()
+            if action == "Ignore":
+                self.log.warning(
+                    "The file is ignored. Proceeding with the next file.")
+            elif action == "Retry":
+                self.log.warning("Trying to upload file again.")
+                upload_result = self.upload_resource(fhir_file, rewrite_version)
                 if 200 <= upload_result.status_code < 300:
                     self.log.debug(f"uploaded {fhir_file.resource_type} with status {upload_result.status_code}")
                 else:
-                    self.log.error(f"Error status code {upload_result.status_code} for {fhir_file.file_path} " +
-                                   f"({fhir_file.resource_type})")
-                    operation_outcome = upload_result.json()
-                    self.log.error(operation_outcome["issue"])
-                    if self.args.non_interactive:
-                        action = "Ignore"
-                    else:
-                        choices = [
-                            inquirer.List('action',
-                                          f"What should we do? (current package: {package_node}):",
-                                          choices=[("Ignore (continue with the next resource)", "Ignore"),
-                                                   ("Retry (because you have changed/uploaded something else)", "Retry")
-                                                   ])
-                        ]
-                        sys.stdout.flush()
-                        action = inquirer.prompt(choices)['action']
-                        sys.stdout.flush()
-                    if action == "Ignore":
-                        self.log.warning(
-                            "The file is ignored. Proceeding with the next file.")
-                    elif action == "Retry":
-                        self.log.warning("Trying to upload file again.")
-                        fhir_files.insert(0, fhir_file)
+                    self.log_upload_failure(f"{fhir_file.file_path} ({fhir_file.resource_type})", upload_result)
+                    failed_files.appendleft(fhir_file)
 
     @staticmethod
     def sort_fhir_files(fhir_files: List[FhirResource]):
@@ -693,24 +1024,43 @@ class Populator:
         :param fhir_files: the fhir file list
         :return: the sorted fhir file list
         """
-
-        def sort_key(x: FhirResource):
-            return x.resource_order, x.resource_type
-
-        fhir_files.sort(key=sort_key)
+        fhir_files.sort(key=operator.attrgetter("resource_order", "resource_type"))
         return fhir_files
 
+    @staticmethod
+    def iter_files(root: str):
+        """
+        recursively yield os.DirEntry objects for every file below root. os.scandir reuses the
+        directory metadata returned by the kernel, so no extra stat() call is issued per entry,
+        unlike os.walk + os.path.join.
+        :param root: the directory to enumerate
+        :return: a generator of os.DirEntry objects
+        """
+        for entry in os.scandir(root):
+            if entry.is_dir(follow_symlinks=False):
+                yield from Populator.iter_files(entry.path)
+            elif entry.is_file():
+                yield entry
+
     def read_package_json(self, package_path: str) -> Optional[dict]:
-        all_files = []
-        for (directory_path, _, filenames) in os.walk(package_path):
-            for file_name in filenames:
-                all_files.append(os.path.join(directory_path, file_name))
-        package_json_file = [f for f in all_files if "package.json" in f]
+        # gather_dependencies and upload_resources both need the package.json of every package;
+        # cache the parsed dict so each package directory is only walked and parsed once
+        if package_path in self.package_json_cache:
+            return self.package_json_cache[package_path]
+        # the FHIR NPM Package Spec pins package.json to the package/ subfolder; probe that
+        # directly and only fall back to a full walk for non-conforming archives
+        spec_path = os.path.join(package_path, "package", "package.json")
+        if os.path.isfile(spec_path):
+            package_json_file = [spec_path]
+        else:
+            package_json_file = [entry.path for entry in self.iter_files(package_path)
+                                 if entry.name == "package.json"]
         if len(package_json_file) != 1:
             self.log.error(f"Within the package {package_path}, one and only one package.json must be present")
             return None
-        with open(package_json_file[0], encoding="utf8") as jf:
-            package_json = json.load(jf)
+        with open(package_json_file[0], "rb") as jf:
+            package_json = orjson.loads(jf.read())
+        self.package_json_cache[package_path] = package_json
         return package_json
 
     def gather_dependencies(self, package_path: str) -> Optional[List[str]]: